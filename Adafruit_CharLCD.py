@@ -6,6 +6,7 @@
 # LiquidCrystal - https://github.com/arduino/Arduino/blob/master/libraries/LiquidCrystal/LiquidCrystal.cpp
 #
 
+from collections import OrderedDict
 from time import sleep
 
 
@@ -53,6 +54,13 @@ class Adafruit_CharLCD(object):
     LCD_5x10DOTS            = 0x04
     LCD_5x8DOTS             = 0x00
 
+    # execution times in microseconds, clear and home are the slow ones
+    LCD_COMMAND_DELAY       = 40
+    LCD_LONG_DELAY          = 2000
+
+    # custom characters
+    LCD_CGRAM_SLOTS         = 8
+
     def __init__(self, pin_rs=25, pin_e=24, pins_db=[23, 17, 21, 22], GPIO=None):
         # Emulate the old behavior of using RPi.GPIO if we haven't been given
         # an explicit GPIO interface to use
@@ -71,8 +79,29 @@ class Adafruit_CharLCD(object):
         for pin in self.pins_db:
             self.GPIO.setup(pin, GPIO.OUT)
 
-        self.write4bits(0x33)  # initialization
-        self.write4bits(0x32)  # initialization
+        # data pin levels for each nibble value, D4 carries the lowest bit
+        self.nibble_levels = [[bool(nibble >> i & 1) for i in range(len(self.pins_db))]
+                              for nibble in range(16)]
+        # current levels, None until first written
+        self.db_levels = [None] * len(self.pins_db)
+        self.rs_level = None
+        self.GPIO.output(self.pin_e, False)
+
+        # custom glyphs resident in CGRAM, least recently used first
+        self.glyphs = OrderedDict()
+        self.glyph_uploads = 0
+
+        # initialization, the LCD starts in 8-bit mode so each nibble goes on its own
+        self.GPIO.output(self.pin_rs, False)
+        self.rs_level = False
+        self.writeNibble(0x3)
+        self.delayMicroseconds(4100)  # the first function set needs > 4.1ms
+        self.writeNibble(0x3)
+        self.delayMicroseconds(100)  # the second needs > 100us
+        self.writeNibble(0x3)
+        self.delayMicroseconds(100)
+        self.writeNibble(0x2)  # switch to 4-bit mode
+        self.delayMicroseconds(self.LCD_COMMAND_DELAY)
         self.write4bits(0x28)  # 2 line 5x7 matrix
         self.write4bits(0x0C)  # turn cursor off 0x0E to enable cursor
         self.write4bits(0x06)  # shift cursor right
@@ -95,11 +124,11 @@ class Adafruit_CharLCD(object):
 
     def home(self):
         self.write4bits(self.LCD_RETURNHOME)  # set cursor position to zero
-        self.delayMicroseconds(3000)  # this command takes a long time!
+        self.delayMicroseconds(self.LCD_LONG_DELAY)  # this command takes a long time!
 
     def clear(self):
         self.write4bits(self.LCD_CLEARDISPLAY)  # command to clear display
-        self.delayMicroseconds(3000)  # 3000 microsecond sleep, clearing the display takes a long time
+        self.delayMicroseconds(self.LCD_LONG_DELAY)  # clearing the display takes a long time
 
     def setCursor(self, col, row):
         self.row_offsets = [0x00, 0x40, 0x14, 0x54]
@@ -165,22 +194,49 @@ class Adafruit_CharLCD(object):
         self.displaymode &= ~self.LCD_ENTRYSHIFTINCREMENT
         self.write4bits(self.LCD_ENTRYMODESET | self.displaymode)
 
+    def createChar(self, location, bitmap):
+        """ Store a 5x8 custom character, given as 8 rows, in a CGRAM slot """
+        location &= self.LCD_CGRAM_SLOTS - 1
+        self.write4bits(self.LCD_SETCGRAMADDR | (location << 3))
+        for row in bitmap:
+            self.write4bits(row, True)
+
+    def glyph(self, key, bitmap, visible=()):
+        """
+        Return the character code for a custom glyph, only uploading it on a miss.
+        The least recently used glyph is evicted, preferring slots not in visible.
+        Uploading moves the address into CGRAM, so call setCursor before writing
+        """
+        if key in self.glyphs:
+            slot = self.glyphs.pop(key)
+        else:
+            if len(self.glyphs) < self.LCD_CGRAM_SLOTS:
+                slot = len(self.glyphs)
+            else:
+                hidden = [k for k in self.glyphs if self.glyphs[k] not in visible]
+                slot = self.glyphs.pop(hidden[0] if hidden else next(iter(self.glyphs)))
+            self.createChar(slot, bitmap)
+            self.glyph_uploads += 1
+        self.glyphs[key] = slot
+        return slot
+
     def write4bits(self, bits, char_mode=False):
         """ Send command to LCD """
-        self.delayMicroseconds(1000)  # 1000 microsecond sleep
-        bits = bin(bits)[2:].zfill(8)
-        self.GPIO.output(self.pin_rs, char_mode)
-        for pin in self.pins_db:
-            self.GPIO.output(pin, False)
-        for i in range(4):
-            if bits[i] == "1":
-                self.GPIO.output(self.pins_db[::-1][i], True)
-        self.pulseEnable()
-        for pin in self.pins_db:
-            self.GPIO.output(pin, False)
-        for i in range(4, 8):
-            if bits[i] == "1":
-                self.GPIO.output(self.pins_db[::-1][i-4], True)
+        char_mode = bool(char_mode)
+        if self.rs_level != char_mode:
+            self.GPIO.output(self.pin_rs, char_mode)
+            self.rs_level = char_mode
+        self.writeNibble(bits >> 4)
+        self.writeNibble(bits & 0x0F)
+        self.delayMicroseconds(self.LCD_COMMAND_DELAY)
+
+    def writeNibble(self, nibble):
+        """ Set the data pins for one nibble, touching only those that change """
+        levels = self.nibble_levels[nibble]
+        for i in range(len(self.pins_db)):
+            if self.db_levels[i] != levels[i]:
+                self.GPIO.output(self.pins_db[i], levels[i])
+                self.db_levels[i] = levels[i]
         self.pulseEnable()
 
     def delayMicroseconds(self, microseconds):
@@ -188,12 +244,10 @@ class Adafruit_CharLCD(object):
         sleep(seconds)
 
     def pulseEnable(self):
-        self.GPIO.output(self.pin_e, False)
-        self.delayMicroseconds(1)       # 1 microsecond pause - enable pulse must be > 450ns
+        # enable is left low between pulses, and a GPIO call from Python
+        # already takes longer than the 450ns the pulse needs
         self.GPIO.output(self.pin_e, True)
-        self.delayMicroseconds(1)       # 1 microsecond pause - enable pulse must be > 450ns
         self.GPIO.output(self.pin_e, False)
-        self.delayMicroseconds(1)       # commands need > 37us to settle
 
     def message(self, text):
         """ Send string to LCD. Newline wraps to second line"""
@@ -0,0 +1,121 @@
+import os
+import sqlite3
+import threading
+import time
+import Queue
+# sudo apt-get install python-imaging
+try:
+    from PIL import Image
+    THUMBNAILS_AVAILABLE = True
+except ImportError:
+    THUMBNAILS_AVAILABLE = False
+
+ARCHIVE_DIR = "photos"
+ARCHIVE_MAX_BYTES = 200000000
+THUMBNAIL_SIZE = (160, 120)
+
+class PhotoArchive(object):
+    """
+    This class files photos by time, indexed in SQLite along with what the 'Bot
+    was doing when each was taken. Thumbnails are made by a pool of worker threads,
+    and the oldest photos are removed once the archive grows past max_bytes
+    """
+    def __init__(self, directory=ARCHIVE_DIR, max_bytes=ARCHIVE_MAX_BYTES, workers=2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(os.path.join(directory, "thumbs")):
+            os.makedirs(os.path.join(directory, "thumbs"))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        with self.lock:
+            self.db.execute("CREATE TABLE IF NOT EXISTS photos (id INTEGER PRIMARY KEY, taken REAL, "
+                            "filename TEXT, thumbnail TEXT, motor TEXT, distance REAL, size INTEGER)")
+            self.db.commit()
+        self.thumbnails = Queue.Queue()
+        self.workers = []
+        for worker in range(workers if THUMBNAILS_AVAILABLE else 0):
+            thread = threading.Thread(target=self.make_thumbnails)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def cleanup(self):
+        for worker in self.workers:
+            self.thumbnails.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.db.close()
+
+    def add(self, frame, taken, motor=None, distance=None):
+        filename = time.strftime("%Y%m%d_%H%M%S", time.localtime(taken)) + "_%03d.jpg" % (taken % 1 * 1000)
+        with open(os.path.join(self.directory, filename), "wb") as photo_file:
+            photo_file.write(frame)
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO photos (taken, filename, motor, distance, size) "
+                                     "VALUES (?, ?, ?, ?, ?)", (taken, filename, motor, distance, len(frame)))
+            self.db.commit()
+        if THUMBNAILS_AVAILABLE:
+            self.thumbnails.put((cursor.lastrowid, filename))
+        self.trim()
+        return cursor.lastrowid
+
+    def make_thumbnails(self):
+        while True:
+            item = self.thumbnails.get()
+            if item is None:
+                return
+            photo_id, filename = item
+            try:
+                image = Image.open(os.path.join(self.directory, filename))
+                image.thumbnail(THUMBNAIL_SIZE)
+                image.save(os.path.join(self.directory, "thumbs", filename), "JPEG")
+            except (IOError, OSError):
+                # Already trimmed, or not a usable image
+                continue
+            with self.lock:
+                self.db.execute("UPDATE photos SET thumbnail = ? WHERE id = ?", (filename, photo_id))
+                self.db.commit()
+
+    def trim(self):
+        with self.lock:
+            total = self.db.execute("SELECT SUM(size) FROM photos").fetchone()[0] or 0
+            while total > self.max_bytes:
+                photo_id, filename, thumbnail, size = self.db.execute(
+                    "SELECT id, filename, thumbnail, size FROM photos ORDER BY id LIMIT 1").fetchone()
+                self.remove_file(filename)
+                if thumbnail:
+                    self.remove_file(os.path.join("thumbs", thumbnail))
+                self.db.execute("DELETE FROM photos WHERE id = ?", (photo_id,))
+                total -= size
+            self.db.commit()
+
+    def remove_file(self, filename):
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except OSError:
+            pass
+
+    def page(self, page=0, per_page=20):
+        """ One page of photos, newest first, and the number of pages """
+        page = max(0, page)
+        per_page = max(1, per_page)
+        with self.lock:
+            count = self.db.execute("SELECT COUNT(*) FROM photos").fetchone()[0]
+            rows = self.db.execute("SELECT id, taken, thumbnail, motor, distance FROM photos "
+                                   "ORDER BY id DESC LIMIT ? OFFSET ?", (per_page, page * per_page)).fetchall()
+        photos = []
+        for photo_id, taken, thumbnail, motor, distance in rows:
+            photos.append({"id": photo_id, "taken": taken, "motor": motor, "distance": distance,
+                           "photo": "photos/%d.jpg" % photo_id,
+                           "thumbnail": "photos/%d_thumb.jpg" % photo_id if thumbnail else None})
+        return photos, (count + per_page - 1) // per_page
+
+    def path(self, photo_id, thumbnail=False):
+        """ The file holding a photo or its thumbnail, or None if there isn't one """
+        with self.lock:
+            row = self.db.execute("SELECT filename, thumbnail FROM photos WHERE id = ?", (photo_id,)).fetchone()
+        if not row:
+            return None
+        if thumbnail:
+            return row[1] and os.path.join(self.directory, "thumbs", row[1])
+        return os.path.join(self.directory, row[0])
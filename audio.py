@@ -1,10 +1,19 @@
+import collections
+import hashlib
+import logging
 import os
-from subprocess import Popen
+import tempfile
+import threading
+from subprocess import Popen, call
 # sudo apt-get install alsa-utils espeak mplayer python-pip
 # sudo pip install praw pyttsx
 import pyttsx
 from component import Component
 
+log = logging.getLogger(__name__)
+# Clips still being written by espeak, which trim() leaves alone
+TEMP_PREFIX = "rendering_"
+
 #pocketsphinx for speech recognition
 # ? http://cmusphinx.sourceforge.net/wiki/raspberrypi
 
@@ -28,16 +37,145 @@ class Audio(Component):
     def play(self, filename):
         Popen(["mplayer", "-really-quiet", "-noconsolecontrols", filename])
 
+class PhraseCache(object):
+    """
+    This class keeps phrases rendered by espeak as wav files, keyed by
+    their text and voice settings. The least recently played are removed
+    once the cache grows past max_bytes. The speech and prewarm threads share it,
+    so the files are only renamed, touched or removed under a lock
+    """
+    def __init__(self, directory="speech_cache", voice="en", rate=160, max_bytes=10000000):
+        self.directory = directory
+        self.voice = voice
+        self.rate = rate
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, text):
+        key = "%s|%s|%s" % (self.voice, self.rate, text)
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".wav")
+
+    def get(self, text):
+        """ Return the clip for text, rendering it if needed, or None if espeak fails """
+        path = self.path(text)
+        with self.lock:
+            try:
+                os.utime(path, None)
+                return path
+            except OSError:
+                pass
+        return self.render(text)
+
+    def warm(self, phrases):
+        for text in phrases:
+            if not os.path.exists(self.path(text)):
+                self.render(text)
+
+    def render(self, text):
+        handle, temp = tempfile.mkstemp(suffix=".wav", prefix=TEMP_PREFIX, dir=self.directory)
+        os.close(handle)
+        try:
+            result = call(["espeak", "-v", self.voice, "-s", str(self.rate), "-w", temp, text])
+        except OSError:
+            result = None
+        if result != 0:
+            os.remove(temp)
+            return None
+        path = self.path(text)
+        with self.lock:
+            os.rename(temp, path)
+            self.trim()
+        return path
+
+    def trim(self):
+        """ Remove the least recently played clips, called with the lock held """
+        clips = []
+        for name in os.listdir(self.directory):
+            if name.startswith(TEMP_PREFIX):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            clips.append((stat.st_mtime, stat.st_size, name))
+        total = sum(clip[1] for clip in clips)
+        for mtime, size, name in sorted(clips):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
 class Speech(Component):
     """
-    This class allows the robot to speak
+    This class allows the robot to speak.
+    Messages are queued and spoken by a worker thread, so callers never wait on audio
     """
-    def __init__(self):
+    def __init__(self, max_queue=4):
         self.engine = pyttsx.init()
+        self.cache = PhraseCache(rate=self.engine.getProperty("rate"))
+        self.pending = collections.deque()
+        self.max_queue = max_queue
+        self.superseded = 0
+        self.dropped = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
 
     def cleanup(self):
+        with self.condition:
+            self.running = False
+            self.pending.clear()
+            self.condition.notify()
+        self.thread.join()
         self.engine.stop()
 
-    def speak(self, message):
-        self.engine.say(message)
-        self.engine.runAndWait()
+    def speak(self, message, channel=None):
+        """
+        Queue a message. It replaces anything still waiting on the same channel,
+        and the oldest message is dropped when the queue is full
+        """
+        with self.condition:
+            if channel is not None:
+                waiting = len(self.pending)
+                self.pending = collections.deque(item for item in self.pending if item[0] != channel)
+                self.superseded += waiting - len(self.pending)
+            self.pending.append((channel, message))
+            while len(self.pending) > self.max_queue:
+                self.pending.popleft()
+                self.dropped += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                channel, message = self.pending.popleft()
+            try:
+                self.say(message)
+            except Exception:
+                # One bad message must not silence the 'Bot for the rest of the session
+                log.exception("Could not say %r", message)
+
+    def prewarm(self, phrases):
+        """ Render any phrases missing from the cache in the background """
+        warmer = threading.Thread(target=self.cache.warm, args=(list(phrases),))
+        warmer.daemon = True
+        warmer.start()
+
+    def say(self, message):
+        clip = self.cache.get(message)
+        if clip:
+            call(["aplay", "-q", clip])
+        else:
+            self.engine.say(message)
+            self.engine.runAndWait()
@@ -5,6 +5,9 @@ class Buttons(Component):
     """
     This class awaits the press of one of the two buttons
     """
+    # Held buttons fire on every check, so this also sets the repeat rate
+    period = 0.1
+
     class ButtonHandler(EventHandler):
         def __init__(self, pin):
             EventHandler.__init__(self)
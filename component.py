@@ -1,5 +1,10 @@
 class Component(object):
 
+    # Seconds between calls to check(), or None if it has nothing to do
+    period = None
+    # The Scheduler running this component, once it has been added to one
+    scheduler = None
+
     def __init__(self):
         pass
 
@@ -9,12 +14,26 @@ class Component(object):
     def check(self):
         pass
 
+    def next_check(self, deadline):
+        return deadline + self.period
+
     def update_menu(self, menu):
         pass
 
+# Event priorities, most urgent first. Safety events never wait in a queue
+SAFETY = 0
+HIGH = 1
+NORMAL = 2
+LOW = 3
+
 class EventHandler(object):
-    def __init__(self):
+    # An EventBus, once there is one, times the handlers and queues asynchronous events
+    bus = None
+
+    def __init__(self, priority=NORMAL, asynchronous=False):
         self.handlers = []
+        self.priority = priority
+        self.asynchronous = asynchronous
 
     def add(self, func):
         self.handlers.append(func)
@@ -23,5 +42,10 @@ class EventHandler(object):
         self.handlers.remove(func)
 
     def fire(self, *args, **kwargs):
-        for handler in self.handlers:
-            handler(*args, **kwargs)
+        if self.bus is None:
+            for handler in self.handlers:
+                handler(*args, **kwargs)
+        elif self.asynchronous:
+            self.bus.post(self, args, kwargs)
+        else:
+            self.bus.dispatch(self, args, kwargs)
@@ -1,20 +1,46 @@
+import collections
 import curses
+import threading
 import RPi.GPIO as GPIO
 # sudo apt-get install git
 # git clone git://github.com/adafruit/Adafruit-Raspberry-Pi-Python-Code.git
 import Adafruit_CharLCD
 from component import Component
 
+LCD_COLS = 16
+LCD_ROWS = 2
+
+def bar_glyph(columns):
+    return [(0b11111 << (5 - columns)) & 0b11111] * 8
+
+# Custom 5x8 glyphs, with the character used in their place on the console
+GLYPHS = {
+    "folder": ([0b00000, 0b11100, 0b10011, 0b10001, 0b10001, 0b11111, 0b00000, 0b00000], "/"),
+    "back": ([0b00000, 0b00100, 0b01000, 0b11111, 0b01000, 0b00100, 0b00000, 0b00000], "<"),
+    "bar1": (bar_glyph(1), "1"),
+    "bar2": (bar_glyph(2), "2"),
+    "bar3": (bar_glyph(3), "3"),
+    "bar4": (bar_glyph(4), "4"),
+    "bar5": (bar_glyph(5), "5"),
+}
+GLYPH_NAMES = sorted(GLYPHS)
+# Glyphs travel through the text as these characters, which the LCD leaves blank
+GLYPH_BASE = 0x10
+
 class ConsoleDisplay(Component):
     """
     This class shows output to the console if an LCD is not available
     """
+    # Changes are batched up and sent to the terminal at most this often
+    period = 0.05
+
     def __init__(self):
         self.stdscr = curses.initscr()
         curses.noecho()
         curses.cbreak()
         self.stdscr.keypad(1)
         self.stdscr.nodelay(True)
+        self.dirty = False
 
     def cleanup(self):
         curses.nocbreak()
@@ -23,17 +49,86 @@ class ConsoleDisplay(Component):
         curses.endwin()
 
     def reset(self):
-        self.cleanup()
-        self.__init__()
+        """ Blank the screen, without reinitialising curses """
+        self.display("")
 
     def display(self, text):
-        self.stdscr.clear()
-        self.stdscr.addstr(0, 0, text)
-        self.stdscr.refresh()
+        self.stdscr.erase()
+        ConsoleDisplay.display_at(self, 0, 0, text)
 
     def display_at(self, row, col, text):
         self.stdscr.addstr(row, col, text)
-        self.stdscr.refresh()
+        # Only updates curses' idea of the screen, check() sends it
+        self.stdscr.noutrefresh()
+        self.dirty = True
+
+    def check(self):
+        if self.dirty:
+            curses.doupdate()
+            self.dirty = False
+
+    def glyph(self, name):
+        return GLYPHS[name][1]
+
+class DisplayWriter(object):
+    """
+    This class sends updates to the display from a single thread.
+    A newer update to the same region replaces one still waiting to be written
+    """
+    def __init__(self, write):
+        self.write = write
+        self.pending = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.coalesced = 0
+        self.dropped = 0
+        self.written = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def post(self, row, col, text):
+        with self.condition:
+            region = (row, col, len(text))
+            if region in self.pending:
+                del self.pending[region]
+                self.coalesced += 1
+            self.pending[region] = text
+            self.condition.notify()
+
+    def post_screen(self, lines):
+        with self.condition:
+            # Everything waiting is about to be overwritten
+            self.dropped += len(self.pending)
+            self.pending.clear()
+            for row, line in enumerate(lines):
+                self.pending[(row, 0, len(line))] = line
+            self.condition.notify()
+
+    def depth(self):
+        return len(self.pending)
+
+    def stats(self):
+        return {"depth": self.depth(), "written": self.written,
+                "coalesced": self.coalesced, "dropped": self.dropped}
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                (row, col, length), text = self.pending.popitem(last=False)
+            self.write(row, col, text)
+            self.written += 1
+
+    def stop(self):
+        """ Stop once everything pending has been written """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
 
 class LCDDisplay(ConsoleDisplay):
     """
@@ -42,10 +137,14 @@ class LCDDisplay(ConsoleDisplay):
     def __init__(self, pin_rs=25, pin_en=24, data_pins=[9, 10, 21, 11]):
         ConsoleDisplay.__init__(self)
         self.lcd = Adafruit_CharLCD.Adafruit_CharLCD(pin_rs, pin_en, data_pins)
-        self.lcd.begin(16, 2)
+        self.lcd.begin(LCD_COLS, LCD_ROWS)
+        # What is currently on the glass, the LCD is cleared when it starts
+        self.shadow = [[" "] * LCD_COLS for row in range(LCD_ROWS)]
+        self.writer = DisplayWriter(self.write)
 
     def cleanup(self):
         ConsoleDisplay.cleanup(self)
+        self.writer.stop()
         self.lcd.clear()
         GPIO.cleanup(self.lcd.pin_rs)
         GPIO.cleanup(self.lcd.pin_e)
@@ -53,14 +152,66 @@ class LCDDisplay(ConsoleDisplay):
             GPIO.cleanup(pin)
 
     def display(self, text):
-        ConsoleDisplay.display(self, text)
-        self.lcd.clear()
-        self.lcd.message(text)
+        ConsoleDisplay.display(self, self.console_text(text))
+        lines = text.split("\n") + [""] * LCD_ROWS
+        self.writer.post_screen([line.ljust(LCD_COLS) for line in lines[:LCD_ROWS]])
 
     def display_at(self, row, col, text):
-        ConsoleDisplay.display_at(self, row, col, text)
-        self.lcd.setCursor(col, row)
-        self.lcd.message(text)
+        ConsoleDisplay.display_at(self, row, col, self.console_text(text))
+        self.writer.post(row, col, text)
+
+    def glyph(self, name):
+        return chr(GLYPH_BASE + GLYPH_NAMES.index(name))
+
+    def glyph_name(self, char):
+        index = ord(char) - GLYPH_BASE
+        if 0 <= index < len(GLYPH_NAMES):
+            return GLYPH_NAMES[index]
+        return None
+
+    def console_text(self, text):
+        return "".join(GLYPHS[self.glyph_name(c)][1] if self.glyph_name(c) else c for c in text)
+
+    def lcd_text(self, text):
+        """ Swap glyphs for their CGRAM character codes, uploading any that are missing """
+        visible = set()
+        for row in self.shadow:
+            for cell in row:
+                name = self.glyph_name(cell)
+                if name in self.lcd.glyphs:
+                    visible.add(self.lcd.glyphs[name])
+        chars = []
+        for char in text:
+            name = self.glyph_name(char)
+            if name:
+                code = self.lcd.glyph(name, GLYPHS[name][0], visible)
+                visible.add(code)
+                char = chr(code)
+            chars.append(char)
+        return "".join(chars)
+
+    def write(self, row, col, text):
+        """
+        Send only the runs of characters that differ from the shadow buffer.
+        Runs one unchanged cell apart are joined, as that costs the same as
+        a second setCursor
+        """
+        if row >= LCD_ROWS:
+            return
+        cells = self.shadow[row]
+        text = text[:LCD_COLS - col]
+        changed = [i for i in range(len(text)) if cells[col + i] != text[i]]
+        runs = []
+        for i in changed:
+            if runs and i - runs[-1][1] <= 2:
+                runs[-1][1] = i
+            else:
+                runs.append([i, i])
+        for start, end in runs:
+            run = self.lcd_text(text[start:end + 1])
+            self.lcd.setCursor(col + start, row)
+            self.lcd.message(run)
+            cells[col + start:col + end + 1] = list(text[start:end + 1])
 
     def scrollLeft(self):
         self.lcd.ScrollLeft()
@@ -1,64 +1,216 @@
+import collections
+import threading
 import time
 import RPi.GPIO as GPIO
-from component import Component, EventHandler
+from component import Component, EventHandler, LOW, SAFETY
+from scheduler import monotonic
+
+# The HC-SR04 gives up after about 38ms when nothing reflects the pulse
+ECHO_TIMEOUT = 0.04
+# Sampling slows down as the path clears, scanning at this many cm per second
+SCAN_SPEED = 1000.0
+MIN_INTERVAL = 0.03
+MAX_INTERVAL = 0.5
+# Missing this many readings in a row leaves the distance unknown
+STALE_READINGS = 3
+# The proximity bar starts to fill inside this distance
+BAR_RANGE = 100.0
+
+class EchoSampler(object):
+    """
+    This class triggers the sensor from a background thread and times the
+    returning pulse with GPIO edge callbacks, so nothing waits on the echo
+    """
+    def __init__(self, send_pin, return_pin, interval=0.06, size=16):
+        self.SEND = send_pin
+        self.RETURN = return_pin
+        self.interval = interval
+        self.readings = collections.deque(maxlen=size)
+        self.pulse_start = None
+        self.triggered = None
+        self.echoed = threading.Event()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        GPIO.add_event_detect(self.RETURN, GPIO.BOTH, callback=self.edge)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+        GPIO.remove_event_detect(self.RETURN)
+
+    def edge(self, channel):
+        # A short pulse can be over before the callback runs, so the pin level can't be
+        # trusted. The first edge after each trigger starts the pulse and the next ends it
+        now = monotonic()
+        if self.triggered is None or now < self.triggered:
+            return
+        if self.pulse_start is None:
+            self.pulse_start = now
+        else:
+            self.readings.append((now, (now - self.pulse_start) * 17000))
+            self.pulse_start = None
+            self.echoed.set()
+
+    def run(self):
+        while self.running:
+            self.echoed.clear()
+            self.pulse_start = None
+            self.triggered = monotonic()
+            GPIO.output(self.SEND, 1)
+            time.sleep(0.00001)
+            GPIO.output(self.SEND, 0)
+            self.echoed.wait(ECHO_TIMEOUT)
+            # Edges after this belong to no pulse
+            self.triggered = None
+            time.sleep(self.interval)
+
+    def latest(self):
+        try:
+            return self.readings[-1]
+        except IndexError:
+            return None
+
+class RangeEstimator(object):
+    """
+    This class filters echo readings and tracks how quickly an obstacle is closing.
+    A median filter rejects the odd wild reading, then an alpha-beta filter
+    estimates distance and velocity
+    """
+    def __init__(self, window=5, alpha=0.5, beta=0.1):
+        self.raw = collections.deque(maxlen=window)
+        self.alpha = alpha
+        self.beta = beta
+        self.distance = None
+        self.velocity = 0.0
+        self.last_time = None
+
+    def update(self, timestamp, distance):
+        self.raw.append(distance)
+        measured = sorted(self.raw)[len(self.raw) // 2]
+        if self.distance is None:
+            self.distance = measured
+        else:
+            dt = timestamp - self.last_time
+            if dt <= 0:
+                return
+            predicted = self.distance + self.velocity * dt
+            residual = measured - predicted
+            self.distance = predicted + self.alpha * residual
+            self.velocity += self.beta * residual / dt
+        self.last_time = timestamp
+
+    def time_to_collision(self, margin=0):
+        """ Seconds until the obstacle is within margin cm, or None if not closing """
+        if self.distance is None or self.velocity >= 0:
+            return None
+        return max(0, self.distance - margin) / -self.velocity
 
 class Echo(Component):
     """
-    This class controls the echo sensor, in an attempt to prevent collisions
+    This class controls the echo sensor, in an attempt to prevent collisions.
+    When readings stop arriving the distance becomes unknown (None), which is
+    treated as unsafe and stops the 'Bot
     """
-    def __init__(self, display, send_pin=0, return_pin=4):
+    period = 0.06
+
+    def __init__(self, display, send_pin=0, return_pin=4, min_distance=15, horizon=0.5):
         self.display = display
         self.SEND = send_pin
         self.RETURN = return_pin
-        self.distance_cm = 0
-        self.last_time = time.time()
+        self.min_distance = min_distance
+        self.horizon = horizon
+        self.distance_cm = None
+        self.last_time = None
+        self.estimator = RangeEstimator()
         GPIO.setup(self.SEND, GPIO.OUT)
         GPIO.setup(self.RETURN, GPIO.IN)
         GPIO.output(self.SEND, 0)
-        self.stop_handler = EventHandler()
+        self.sampler = EchoSampler(self.SEND, self.RETURN, self.period)
+        self.stop_handler = EventHandler(SAFETY)
+        self.distance_handler = EventHandler(LOW, asynchronous=True)
         self.active = False
+        # Set once readings have stopped arriving, until they start again
+        self.stale = False
+        # Whether to stop ahead of time as an obstacle closes in. The stop at
+        # min_distance always applies
+        self.predictive = lambda: True
 
     def update_menu(self, menu):
         menu.add_function("Toggle Echo", self.toggle_active)
 
     def toggle_active(self):
         self.active = not self.active
+        self.distance_cm = None
+        self.stale = False
         if self.active:
+            # Readings from before are too old to say anything about speed
+            self.estimator = RangeEstimator()
+            # Counts as the last reading, so a sensor that never answers is noticed
+            self.last_time = monotonic()
+            self.sampler.start()
             self.display.display("Echo enabled")
         else:
+            self.sampler.stop()
             self.display.display("Echo disabled")
 
     def check(self):
         if not self.active:
             return
-        if time.time() < self.last_time + 0.2:
+        readings = [r for r in list(self.sampler.readings)
+                    if self.last_time is None or r[0] > self.last_time]
+        if not readings:
+            self.check_stale()
             return
-        self.measure()
-        self.last_time = time.time()
-        if self.distance_cm < 15:
+        for timestamp, distance in readings:
+            self.estimator.update(timestamp, distance)
+        self.last_time = readings[-1][0]
+        self.stale = False
+        self.distance_cm = self.estimator.distance
+        ttc = self.estimator.time_to_collision(self.min_distance)
+        if self.distance_cm < self.min_distance or (ttc is not None and ttc < self.horizon and self.predictive()):
             self.stop_handler.fire()
+        self.adjust_rate(ttc)
+        self.distance_handler.fire(int(self.distance_cm))
         msg = str(int(self.distance_cm)) + "cm"
         if len(msg) <= 6:
-            self.display.display_at(1, 11, msg.rjust(6))
+            self.display.display_at(1, 9, self.proximity_bar() + msg.rjust(6))
 
-    def measure(self):
-        init_time = time.time()
-        GPIO.output(self.SEND, 1)
-        time.sleep(0.00001)
-        GPIO.output(self.SEND, 0)
-        start = time.time()
-        while not GPIO.input(self.RETURN):
-            start = time.time()
-            if start > init_time + 5:
-                return
-        stop = time.time()
-        while GPIO.input(self.RETURN):
-            stop = time.time()
-            if stop > init_time + 5:
-                return
-        self.distance_cm = (stop - start) * 17000
+    def check_stale(self):
+        if self.stale:
+            return
+        if monotonic() - self.last_time > STALE_READINGS * (self.sampler.interval + ECHO_TIMEOUT):
+            self.stale = True
+            self.distance_cm = None
+            self.stop_handler.fire()
+            self.distance_handler.fire("?")
+            self.display.display_at(1, 9, "    ?cm")
+
+    def proximity_bar(self):
+        closeness = (BAR_RANGE - self.distance_cm) / (BAR_RANGE - self.min_distance)
+        level = int(min(1, max(0, closeness)) * 5 + 0.5)
+        if level == 0:
+            return " "
+        return self.display.glyph("bar" + str(level))
+
+    def adjust_rate(self, ttc):
+        interval = self.distance_cm / SCAN_SPEED
+        if ttc is not None:
+            interval = min(interval, ttc / 4)
+        interval = min(MAX_INTERVAL, max(MIN_INTERVAL, interval))
+        self.sampler.interval = interval
+        self.period = interval
 
     def cleanup(self):
+        self.sampler.stop()
         GPIO.cleanup(self.SEND)
         GPIO.cleanup(self.RETURN)
-
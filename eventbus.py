@@ -0,0 +1,85 @@
+import heapq
+import logging
+import threading
+from component import Component, SAFETY
+from scheduler import monotonic
+
+log = logging.getLogger(__name__)
+
+class EventBus(Component):
+    """
+    This class runs the handlers for fired events, timing each one.
+    Asynchronous events are queued in priority order and run by a worker thread,
+    while safety events always run straight away, in the thread that fired them,
+    so nothing queued or still running can hold them up
+    """
+    def __init__(self):
+        self.queue = []
+        self.count = 0
+        self.lock = threading.Condition()
+        # Calls, total and longest seconds taken by each handler
+        self.timings = {}
+        self.timings_lock = threading.Lock()
+        self.active = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def cleanup(self):
+        with self.lock:
+            self.active = False
+            self.lock.notify()
+        self.thread.join()
+
+    def post(self, event, args, kwargs):
+        with self.lock:
+            if self.active and event.priority != SAFETY:
+                # The count keeps events of the same priority in order
+                self.count += 1
+                heapq.heappush(self.queue, (event.priority, self.count, event, args, kwargs))
+                self.lock.notify()
+                return
+        self.dispatch(event, args, kwargs)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while self.active and not self.queue:
+                    self.lock.wait()
+                if not self.active:
+                    return
+                priority, count, event, args, kwargs = heapq.heappop(self.queue)
+            # A failing handler must not stop the worker, or every later event would be stuck
+            self.dispatch(event, args, kwargs, log_errors=True)
+
+    def dispatch(self, event, args, kwargs, log_errors=False):
+        for handler in list(event.handlers):
+            start = monotonic()
+            try:
+                handler(*args, **kwargs)
+            except Exception:
+                if not log_errors:
+                    raise
+                log.exception("Event handler %s failed", self.name(handler))
+            finally:
+                self.record(handler, monotonic() - start)
+
+    def record(self, handler, seconds):
+        name = self.name(handler)
+        with self.timings_lock:
+            calls, total, longest = self.timings.get(name, (0, 0, 0))
+            self.timings[name] = (calls + 1, total + seconds, max(longest, seconds))
+
+    def name(self, handler):
+        if hasattr(handler, "im_self"):
+            return handler.im_self.__class__.__name__ + "." + handler.__name__
+        if handler.__name__ == "<lambda>":
+            return "%s:%d" % (handler.__module__, handler.func_code.co_firstlineno)
+        return handler.__name__
+
+    def report(self):
+        with self.timings_lock:
+            if not self.timings:
+                return "No events yet"
+            longest, name = max((timing[2], name) for name, timing in self.timings.items())
+        return "%s %dms" % (name[:10], longest * 1000)
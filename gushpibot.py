@@ -1,15 +1,19 @@
 #!/usr/bin/python
 
+import logging
 import sys
 import time
 from subprocess import Popen, PIPE
 import RPi.GPIO as GPIO
 from buttons import Buttons
+from component import EventHandler
 from echo import Echo
+from eventbus import EventBus
 from keyboard import Keyboard
 from menu import Menu
 from program import Program
-from webcam import Webcam
+from scheduler import Scheduler
+from webcam import Webcam, WEBCAM_PHOTO_FILE
 from webserver import Webserver
 from wheels import Wheels
 try:
@@ -35,6 +39,8 @@ WEBCAM_AVAILABLE = True
 ECHO_AVAILABLE = True
 WEBSERVER_AVAILABLE = True
 
+LOG_FILE = "gushpibot.log"
+
 """
 Default GPIO PIN assigments (Model B revision 1)
 ---------------------------
@@ -69,6 +75,7 @@ class GushPiBot(object):
 
     def startup(self):
         self.create_display()
+        self.create_event_bus()
         self.create_menu()
         self.create_wheels()
         self.create_program()
@@ -103,6 +110,11 @@ class GushPiBot(object):
         self.display_ip()
         self.add_component("Display", self.display)
 
+    def create_event_bus(self):
+        self.event_bus = EventBus()
+        EventHandler.bus = self.event_bus
+        self.add_component("Event Bus", self.event_bus)
+
     def create_wheels(self):
         self.wheels = Wheels()
         self.add_component("Wheels", self.wheels)
@@ -126,6 +138,7 @@ class GushPiBot(object):
 
     def create_webcam(self):
         self.webcam = Webcam()
+        self.webcam.metadata["motor"] = lambda: self.wheels.state
         self.program.add_command("#", "Photo", self.webcam.take_photo)
         self.add_component("Webcam", self.webcam)
 
@@ -135,7 +148,8 @@ class GushPiBot(object):
         self.wiimote.handlers["DOWN"].add(self.wheels.backwards)
         self.wiimote.handlers["LEFT"].add(self.wheels.left)
         self.wiimote.handlers["RIGHT"].add(self.wheels.right)
-        self.wiimote.handlers["A"].add(self.wheels.stop)
+        self.wiimote.handlers["A"].add(self.wheels.emergency_stop)
+        self.wiimote.handlers["A"].add(self.program.stop)
         try:
             self.wiimote.handlers["B"].add(self.webcam.take_photo)
         except AttributeError:
@@ -149,7 +163,7 @@ class GushPiBot(object):
     def create_speech(self):
         self.speech = Speech()
         self.speech.speak("Hello. I am Gush Pi Bot.")
-        self.wheels.speech_handler.add(self.speech.speak)
+        self.wheels.speech_handler.add(lambda message: self.speech.speak(message, "wheels"))
         self.add_component("Speech", self.speech)
 
     def create_audio(self):
@@ -158,7 +172,15 @@ class GushPiBot(object):
 
     def create_echo(self):
         self.echo = Echo(self.display)
-        self.echo.stop_handler.add(self.wheels.stop)
+        self.echo.stop_handler.add(self.wheels.emergency_stop)
+        self.echo.stop_handler.add(self.program.stop)
+        self.program.add_sensor("e", lambda: self.echo.distance_cm if self.echo.active else None)
+        # A step driving until a distance is reached would otherwise be stopped short of it
+        self.echo.predictive = lambda: not self.program.polling
+        try:
+            self.webcam.metadata["distance"] = lambda: self.echo.distance_cm
+        except AttributeError:
+            pass
         self.add_component("Echo", self.echo)
 
     def create_keyboard(self):
@@ -167,7 +189,8 @@ class GushPiBot(object):
         self.keyboard.handlers["DOWN"].add(self.wheels.backwards)
         self.keyboard.handlers["LEFT"].add(self.wheels.left)
         self.keyboard.handlers["RIGHT"].add(self.wheels.right)
-        self.keyboard.handlers["."].add(self.wheels.stop)
+        self.keyboard.handlers["."].add(self.wheels.emergency_stop)
+        self.keyboard.handlers["."].add(self.program.stop)
         self.keyboard.handlers["{"].add(self.wheels.slow_left)
         self.keyboard.handlers["}"].add(self.wheels.slow_right)
         self.keyboard.handlers["CTRL+X"].add(self.pi_shutdown)
@@ -187,15 +210,30 @@ class GushPiBot(object):
         self.webserver.post_handlers["down"] = self.wheels.backwards
         self.webserver.post_handlers["left"] = self.wheels.left
         self.webserver.post_handlers["right"] = self.wheels.right
-        self.webserver.post_handlers["stop"] = self.wheels.stop
+        self.webserver.post_handlers["stop"] = self.stop_all
         self.webserver.post_handlers["menu_next"] = self.menu.next
         self.webserver.post_handlers["menu_prev"] = self.menu.prev
         self.webserver.post_handlers["menu_select"] = self.menu.select
         self.webserver.post_handlers["menu_text"] = self.menu.text
+        self.webserver.post_data_handlers["program"] = self.program.upload
+        self.webserver.post_data_handlers["program_run"] = lambda data: self.program.upload(data, True)
         try:
             self.webserver.post_handlers["photo"] = self.webcam.take_photo
+            # The photo is only rewritten by the webcam, which says when it has changed
+            self.webserver.assets.watch(WEBCAM_PHOTO_FILE)
+            self.webcam.photo_handler.add(self.webserver.assets.invalidate)
+            self.webcam.photo_handler.add(lambda filename: self.webserver.publish("photo", time.time()))
+            self.webserver.frame_stream = self.webcam.stream
+            self.webserver.archive = self.webcam.archive
         except AttributeError:
             pass
+        try:
+            self.echo.distance_handler.add(lambda distance: self.webserver.publish("distance", distance))
+        except AttributeError:
+            pass
+        self.menu.text_handler.add(lambda text: self.webserver.publish("menu", text))
+        self.wheels.state_handler.add(lambda state: self.webserver.publish("motor", state))
+        self.program.progress_handler.add(lambda progress: self.webserver.publish("program", progress))
         self.webserver.serve()
         self.add_component("Webserver", self.webserver)
 
@@ -210,36 +248,62 @@ class GushPiBot(object):
         self.menu.add_function("Exit", self.exit, menu)
         self.menu.add_function("Shutdown RasPi", self.pi_shutdown, menu)
         self.menu.add_function("IP Address", self.display_ip, menu)
+        self.menu.add_function("Overruns", self.display_overruns, menu)
+        self.menu.add_function("Motor Writes", self.display_motor_writes, menu)
+        self.menu.add_function("Ramp Jitter", self.display_ramp_jitter, menu)
+        self.menu.add_function("Slowest Handler", self.display_slowest_handler, menu)
         try:
             self.menu.speech = self.speech
+            self.speech.prewarm(set(self.menu.labels() + Wheels.PHRASES))
         except AttributeError:
             pass
 
     def run(self, program=None):
         if program:
             self.display.display("GushPiBot...\nRunning...")
-            self.program.set(program)
+            try:
+                self.program.set(program)
+            except ValueError as error:
+                self.display.display_at(1, 0, str(error).ljust(16))
+                return
             self.program.view()
             self.program.run()
         else:
             self.display.display("GushPiBot...\nListening...")
-            while self.loop_cycle():
-                time.sleep(0.1)
+        self.scheduler = Scheduler(self.components)
+        # A program given on the command line exits once it has finished
+        while self.active and (self.program.active or not program):
+            self.scheduler.run_once()
 
     def display_ip(self):
         p = Popen("hostname -I", shell=True, stdout=PIPE)
         output = p.communicate()[0].split("\n")[0]
         self.display.display_at(1, 0, output.ljust(16))
 
+    def display_motor_writes(self):
+        self.display.display_at(1, 0, self.wheels.report().ljust(16))
+
+    def display_ramp_jitter(self):
+        self.display.display_at(1, 0, self.wheels.jitter_report().ljust(16))
+
+    def display_slowest_handler(self):
+        self.display.display_at(1, 0, self.event_bus.report().ljust(16))
+
+    def display_overruns(self):
+        try:
+            self.display.display_at(1, 0, self.scheduler.report().ljust(16))
+        except AttributeError:
+            pass
+
+    def stop_all(self):
+        """ Cut the motors and stop any program, so its next step can't start them again """
+        self.wheels.emergency_stop()
+        self.program.stop()
+
     def exit(self):
         self.display.display("GushPiBot...\nExiting...")
         self.active = False
 
-    def loop_cycle(self):
-        for item in self.components:
-            item.check()
-        return self.active
-
     def cleanup(self):
         for item in self.components:
             try:
@@ -257,6 +321,9 @@ class GushPiBot(object):
 
 if __name__ == "__main__":
     print("GushPiBot starting...")
+    # Errors go to a file, as anything printed would upset the curses screen
+    logging.basicConfig(filename=LOG_FILE, level=logging.WARNING,
+                        format="%(asctime)s %(name)s %(levelname)s %(message)s")
     gushpibot = GushPiBot()
     try:
         gushpibot.startup()
@@ -1,24 +1,34 @@
 import curses
-from component import Component, EventHandler
+from component import Component, EventHandler, NORMAL, SAFETY
+from scheduler import monotonic
+
+# Keys that move the 'Bot, dropped from the input when "." is pressed to stop
+MOVEMENT_KEYS = ["UP", "DOWN", "LEFT", "RIGHT", "{", "}"]
+# A key arriving again within this many seconds is auto-repeat, not a new press
+REPEAT_GAP = 0.1
 
 class Keyboard(Component):
     """
-    This class accepts keyboard input
+    This class accepts keyboard input. Each check takes every key waiting, and a key
+    that keeps arriving, as when it is held down, counts as a single press
     """
+    period = 0.01
+
     class KeyboardHandler(EventHandler):
 
-        def __init__(self, key_id):
-            EventHandler.__init__(self)
+        def __init__(self, key_id, priority=NORMAL):
+            EventHandler.__init__(self, priority)
             self.key_id = key_id
 
-    def __init__(self, stdscr):
+    def __init__(self, stdscr, flush_on_stop=True):
         self.stdscr = stdscr
+        self.flush_on_stop = flush_on_stop
         self.handlers = {}
         self.handlers["UP"] = Keyboard.KeyboardHandler(curses.KEY_UP)
         self.handlers["DOWN"] = Keyboard.KeyboardHandler(curses.KEY_DOWN)
         self.handlers["LEFT"] = Keyboard.KeyboardHandler(curses.KEY_LEFT)
         self.handlers["RIGHT"] = Keyboard.KeyboardHandler(curses.KEY_RIGHT)
-        self.handlers["."] = Keyboard.KeyboardHandler(ord("."))
+        self.handlers["."] = Keyboard.KeyboardHandler(ord("."), SAFETY)
         self.handlers["{"] = Keyboard.KeyboardHandler(ord("{"))
         self.handlers["}"] = Keyboard.KeyboardHandler(ord("}"))
         self.handlers["#"] = Keyboard.KeyboardHandler(ord("#"))
@@ -27,11 +37,28 @@ class Keyboard(Component):
         self.handlers["PAGEUP"] = Keyboard.KeyboardHandler(curses.KEY_NPAGE)
         self.handlers["RETURN"] = Keyboard.KeyboardHandler(10)
         self.handlers["ESC"] = Keyboard.KeyboardHandler(27)
+        # Handlers by key code
+        self.keys = dict((handler.key_id, handler) for handler in self.handlers.values())
+        self.movement = set(self.handlers[key].key_id for key in MOVEMENT_KEYS)
+        self.stop_key = self.handlers["."].key_id
+        # The last key read and when, carried between checks to spot auto-repeat
+        self.last_key = None
+        self.last_time = None
 
     def check(self):
+        pressed = []
+        now = monotonic()
         pressed_key = self.stdscr.getch()
-        if pressed_key == curses.ERR:
-            return
-        for key in self.handlers:
-            if pressed_key == self.handlers[key].key_id:
-                self.handlers[key].fire()
+        while pressed_key != curses.ERR:
+            if pressed_key != self.last_key or now - self.last_time >= REPEAT_GAP:
+                pressed.append(pressed_key)
+            self.last_key = pressed_key
+            self.last_time = now
+            pressed_key = self.stdscr.getch()
+        if self.flush_on_stop and self.stop_key in pressed:
+            # Movement typed ahead of the stop is thrown away, so the 'Bot stays stopped
+            stop = len(pressed) - 1 - pressed[::-1].index(self.stop_key)
+            pressed = [key for key in pressed[:stop] if key not in self.movement] + pressed[stop:]
+        for pressed_key in pressed:
+            if pressed_key in self.keys:
+                self.keys[pressed_key].fire()
@@ -1,3 +1,5 @@
+from component import EventHandler
+
 class Menu(object):
 
     class MenuItem(object):
@@ -24,6 +26,7 @@ class Menu(object):
         self.display = display
         self.speech = speech
         self.option = 0
+        self.text_handler = EventHandler()
 
     def add_folder(self, name, folder=None):
         if folder is None:
@@ -38,6 +41,17 @@ class Menu(object):
             folder = self.root
         folder.add(name, func=func)
 
+    def labels(self, folder=None):
+        """ Names of every item in the menu, including those in folders """
+        if folder is None:
+            folder = self.root
+        names = []
+        for item in folder.options:
+            names.append(item.name)
+            if item.name.endswith("/"):
+                names.extend(self.labels(item.folder))
+        return names
+
     def current_item(self):
         return self.menu.options[self.option]
 
@@ -58,10 +72,19 @@ class Menu(object):
     def text(self):
         return self.current_item().name
 
+    def label(self):
+        item = self.current_item()
+        if item.name.endswith("/"):
+            return item.name[:-1] + self.display.glyph("folder")
+        if item.folder:
+            return self.display.glyph("back") + item.name
+        return item.name
+
     def notify(self):
-        self.display.display_at(0, 0, self.text().ljust(16))
+        self.display.display_at(0, 0, self.label().ljust(16))
+        self.text_handler.fire(self.text())
         if self.speech:
-            self.speech.speak(self.text())
+            self.speech.speak(self.text(), "menu")
 
     def select(self):
         if self.current_item().folder:
@@ -1,4 +1,36 @@
-from component import Component
+import collections
+import json
+import math
+import re
+import timeit
+from component import Component, EventHandler
+from scheduler import monotonic
+
+# Seconds a step runs for, unless it is given a duration
+STEP_TIME = 1.0
+# Shortest duration a step can be given
+MIN_STEP_TIME = 0.02
+# Step timings kept for inspection, from the latest run
+TIMINGS_KEPT = 1000
+# Seconds between sensor readings while waiting on a condition
+POLL_TIME = 0.05
+# A sensor compared with a value, like "[e<30]"
+CONDITION = r"\[[a-z]+[<>]\d+(?:\.\d+)?\]"
+# Brackets open a group. A group or step may be followed by a repeat count, a
+# duration with a decimal point, or a condition to repeat until
+TOKEN_PATTERN = re.compile(r"\(|\)(?:\d+|%s)?|[^\s()\[\]](?:\d+(?:\.\d+)?|\.\d+|%s)?" % (CONDITION, CONDITION))
+CONDITION_PATTERN = re.compile(r"^\[([a-z]+)([<>])(\d+(?:\.\d+)?)\]$")
+
+# Opcodes, each followed in the code by a fixed number of arguments
+START = 0   # command                    call the command's start_func
+WAIT = 1    # seconds                    yield until the deadline moves on by seconds
+FINISH = 2  # command                    call the command's finish_func
+LOOP = 3    # slot, count                set a loop counter
+NEXT = 4    # slot, target               count down and jump back while there are repeats left
+TEST = 5    # sensor, less, value, target  jump if the sensor reading passes the test
+POLL = 6    #                            yield for POLL_TIME
+JUMP = 7    # target
+ARGUMENTS = [1, 1, 1, 2, 2, 4, 0, 1]
 
 class Command(object):
     """
@@ -10,35 +42,269 @@ class Command(object):
         self.start_func = start_func
         self.finish_func = finish_func
 
+class Compiler(object):
+    """
+    This class turns program instructions into a flat list of opcodes and arguments.
+    Runs of the same movement are merged into one step, and the finish between steps
+    whose commands finish the same way is left out, as the next start takes over anyway
+    """
+    def __init__(self, commands, sensors):
+        self.commands = commands
+        self.sensors = sensors
+        self.command_table = []
+        self.sensor_table = []
+        self.code = []
+        self.loops = 0
+        # Code before this may be jumped to, so must not be changed
+        self.barrier = 0
+        # Where the last step's WAIT and FINISH are, while they can still be merged
+        self.last_wait = None
+        self.last_finish = None
+
+    def compile(self, instructions):
+        groups = []
+        for instruction in instructions:
+            if instruction == "(":
+                groups.append(self.label())
+            elif instruction.startswith(")"):
+                if not groups:
+                    raise ValueError("Unmatched )")
+                self.close_group(groups.pop(), instruction[1:])
+            else:
+                self.step(instruction[0], instruction[1:])
+        if groups:
+            raise ValueError("Unmatched (")
+        return self.code
+
+    def label(self):
+        self.barrier = len(self.code)
+        self.last_wait = self.last_finish = None
+        return len(self.code)
+
+    def emit(self, *op):
+        self.code.extend(op)
+        return len(self.code) - len(op)
+
+    def close_group(self, start, suffix):
+        if len(self.code) == start:
+            raise ValueError("Empty group")
+        if suffix.startswith("["):
+            test = self.emit(TEST, *(self.condition(suffix) + (None,)))
+            if not self.waits(start):
+                # Otherwise the loop could go round forever without giving the main loop a turn
+                self.emit(POLL)
+            self.emit(JUMP, start)
+            self.code[test + 4] = self.label()
+        elif suffix:
+            if int(suffix) < 1:
+                raise ValueError("Invalid count )%s" % suffix)
+            # The counter is set before the group's first instruction
+            slot = self.loops
+            self.loops += 1
+            self.relocate(start, 3)
+            self.code[start:start] = [LOOP, slot, int(suffix)]
+            self.emit(NEXT, slot, start + 3)
+            self.label()
+
+    def waits(self, start):
+        """ Whether the code from start on always waits, as every group runs at least once """
+        pc = start
+        while pc < len(self.code):
+            if self.code[pc] == WAIT:
+                return True
+            pc += 1 + ARGUMENTS[self.code[pc]]
+        return False
+
+    def relocate(self, start, offset):
+        """ Move the jump targets in the code from start on, ready to insert offset values there """
+        pc = start
+        while pc < len(self.code):
+            op = self.code[pc]
+            target = {NEXT: 2, TEST: 4, JUMP: 1}.get(op)
+            if target and self.code[pc + target] >= start:
+                self.code[pc + target] += offset
+            pc += 1 + ARGUMENTS[op]
+
+    def step(self, shortcut, suffix):
+        command = self.commands[shortcut]
+        index = self.index(self.command_table, command)
+        if suffix.startswith("["):
+            self.start(command, index)
+            test = self.emit(TEST, *(self.condition(suffix) + (None,)))
+            self.emit(POLL)
+            self.emit(JUMP, test)
+            self.code[test + 4] = self.label()
+            self.last_finish = self.emit(FINISH, index)
+            return
+        duration = float(suffix) if suffix else STEP_TIME
+        # Checked here as every program is compiled, however it was entered
+        if duration < MIN_STEP_TIME:
+            raise ValueError("Invalid duration %s" % suffix)
+        if (self.last_wait is not None and self.code[self.last_finish + 1] == index
+                and command.finish_func is not None):
+            # The same movement again, so just run it for longer. Commands without a
+            # finish, like taking a photo, do something each time so are never merged
+            self.code[self.last_wait + 1] += duration
+            return
+        self.start(command, index)
+        self.last_wait = self.emit(WAIT, duration)
+        self.last_finish = self.emit(FINISH, index)
+
+    def start(self, command, index):
+        if self.last_finish is not None and self.last_finish >= self.barrier:
+            previous = self.command_table[self.code[self.last_finish + 1]]
+            if previous.finish_func is not None and previous.finish_func == command.finish_func:
+                del self.code[self.last_finish:self.last_finish + 2]
+        self.emit(START, index)
+        self.last_wait = self.last_finish = None
+
+    def condition(self, text):
+        sensor, comparison, value = CONDITION_PATTERN.match(text).groups()
+        if sensor not in self.sensors:
+            raise ValueError("Unknown sensor %s" % sensor)
+        return self.index(self.sensor_table, self.sensors[sensor]), int(comparison == "<"), float(value)
+
+    def index(self, table, item):
+        if item not in table:
+            table.append(item)
+        return table.index(item)
+
 class Program(Component):
     """
-    This class stores the instructions to run the program
+    This class stores the instructions to run the program.
+    An instruction is a command shortcut, optionally followed by its duration like "^2.5",
+    or a condition to run until like "^[e<30]". Instructions between "(" and ")" form a
+    group, repeated as many times as the number after the ")" or until its condition.
+    The program is compiled to bytecode before it runs, and check() then interprets
+    it, returning to the main loop whenever a step has to wait
     """
+    period = 0.1
+
     def __init__(self, display):
         self.instructions = []
         self.commands = {}
+        self.sensors = {}
+        self.compiler = None
         self.active = False
+        self.pc = 0
+        self.counters = []
+        self.current = None
+        # Whether the current step is waiting on a sensor condition
+        self.polling = False
+        self.steps = 0
+        self.deadline = None
+        # Each step's name and how late it started and ended, in seconds
+        self.timings = collections.deque(maxlen=TIMINGS_KEPT)
         self.display = display
+        self.progress_handler = EventHandler()
 
     def set(self, program):
-        for inst in program:
-            self.add_instruction(inst)
+        """ Add instructions from a string like "^3>2", as printed by str() """
+        for token in TOKEN_PATTERN.findall(program):
+            for instruction in self.expand(token):
+                self.add_instruction(instruction)
+
+    def expand(self, token):
+        """ A step with a repeat count becomes that many steps """
+        if token[0] in "()" or "." in token or "[" in token:
+            return [token]
+        count = int(token[1:] or 1)
+        if count < 1:
+            raise ValueError("Invalid count %s" % token)
+        return [token[0]] * count
 
     def cleanup(self):
         self.stop()
 
     def clear(self):
         self.instructions = []
+        self.compiler = None
 
     def add_command(self, shortcut, name, start_func, finish_func=None):
         self.commands[shortcut] = Command(shortcut, name, start_func, finish_func)
 
+    def add_sensor(self, name, func):
+        """
+        Make a reading available to conditions, like "e" in "[e<30]".
+        The reading is None while the sensor isn't running, which stops the program
+        """
+        self.sensors[name] = func
+
     def add_instruction(self, instruction):
-        if instruction in self.commands.keys():
+        if instruction[:1] in self.commands or instruction[:1] in "()":
             self.instructions.append(instruction)
+            self.compiler = None
+
+    def upload(self, data, start=False):
+        """
+        Replace the program in one go, from a string such as "^^>#" or a JSON list
+        of steps, each a string or like {"command": "^", "duration": 1.5}
+        or {"command": "^", "until": "e<30"}
+        """
+        instructions = self.parse(data)
+        compiler = Compiler(self.commands, self.sensors)
+        compiler.compile(instructions)
+        self.stop()
+        self.instructions = instructions
+        self.compiler = compiler
+        if start:
+            self.run()
+        return str(self)
+
+    def parse(self, data):
+        data = data.strip()
+        if data.startswith("["):
+            try:
+                steps = json.loads(data)
+            except ValueError:
+                raise ValueError("Invalid JSON")
+        else:
+            steps = [data]
+        instructions = []
+        for step in steps:
+            if isinstance(step, dict):
+                instructions.append(self.instruction(step.get("command"), step.get("duration", STEP_TIME),
+                                                     step.get("until")))
+                continue
+            if not isinstance(step, basestring):
+                raise ValueError("Invalid step %s" % json.dumps(step))
+            if TOKEN_PATTERN.sub("", step).strip():
+                raise ValueError("Invalid program %s" % json.dumps(step))
+            for token in TOKEN_PATTERN.findall(step):
+                for instruction in self.expand(token):
+                    if instruction[0] in "()":
+                        instructions.append(str(instruction))
+                    elif "[" in instruction:
+                        instructions.append(self.instruction(instruction[0], STEP_TIME, instruction[2:-1]))
+                    else:
+                        instructions.append(self.instruction(*self.split(instruction)))
+        return instructions
+
+    def instruction(self, shortcut, duration, until=None):
+        """ Check a step is valid and turn it into an instruction """
+        if not isinstance(shortcut, basestring) or shortcut not in self.commands:
+            raise ValueError("Unknown command %s" % json.dumps(shortcut))
+        if until is not None:
+            match = isinstance(until, basestring) and CONDITION_PATTERN.match("[%s]" % until)
+            if not match or match.group(1) not in self.sensors:
+                raise ValueError("Invalid condition %s" % json.dumps(until))
+            return str(shortcut) + "[%s]" % str(until)
+        if (isinstance(duration, bool) or not isinstance(duration, (int, float))
+                or math.isinf(duration) or math.isnan(duration) or duration < MIN_STEP_TIME):
+            raise ValueError("Invalid duration %s" % json.dumps(duration))
+        if duration == STEP_TIME:
+            return str(shortcut)
+        return str(shortcut) + str(duration)
+
+    def split(self, instruction):
+        """ The shortcut and duration of an instruction """
+        if len(instruction) > 1:
+            return instruction[0], float(instruction[1:])
+        return instruction, STEP_TIME
 
     def delete_instruction(self, step=-1):
         del self.instructions[step]
+        self.compiler = None
 
     def update_menu(self, menu):
         folder = menu.add_folder("Program")
@@ -47,22 +313,129 @@ class Program(Component):
             menu.add_function("Add " + self.commands[command].name,
                     lambda c=command: self.add_instruction(self.commands[c].shortcut), folder)
         menu.add_function("Delete Step", self.delete_instruction, folder)
+        menu.add_function("Step Timing", self.view_timings, folder)
         menu.add_function("Run Program", self.run, folder)
         menu.add_function("Stop Program", self.stop, folder)
         menu.add_function("Clear Program", self.clear, folder)
 
+    def compiled(self):
+        """ The compiler holding the bytecode, only compiling again after an edit """
+        if self.compiler is None:
+            compiler = Compiler(self.commands, self.sensors)
+            compiler.compile(self.instructions)
+            self.compiler = compiler
+        return self.compiler
+
     def stop(self):
-        self.active = False
+        if self.active:
+            self.finish_step()
+            self.active = False
+            self.progress_handler.fire("Stopped")
 
     def run(self):
+        """ Start the program, check() runs the rest """
+        self.stop()
+        try:
+            compiler = self.compiled()
+        except ValueError as error:
+            self.display.display_at(1, 0, str(error).ljust(16))
+            return
         self.active = True
-        for instruction in self.instructions:
-            if not self.active:
+        self.pc = 0
+        self.counters = [0] * compiler.loops
+        self.steps = 0
+        self.timings.clear()
+        self.deadline = monotonic()
+        self.execute()
+        if self.scheduler:
+            # Otherwise the next step waits for the check that was due while idle
+            self.scheduler.wake(self, self.deadline)
+
+    def check(self):
+        if self.active and monotonic() >= self.deadline:
+            self.execute()
+
+    def next_check(self, deadline):
+        if self.active:
+            return self.deadline
+        return deadline + self.period
+
+    def execute(self):
+        """ Run instructions until one has to wait, or the program ends """
+        code = self.compiler.code
+        commands = self.compiler.command_table
+        while self.pc < len(code):
+            op = code[self.pc]
+            if op == START:
+                self.current = commands[code[self.pc + 1]]
+                self.polling = False
+                self.steps += 1
+                self.progress_handler.fire("%d %s" % (self.steps, self.current.name))
+                self.end_timing()
+                self.timings.append([self.current.name, monotonic() - self.deadline, None])
+                self.current.start_func()
+            elif op == WAIT:
+                # Deadlines follow on from each other, so time spent starting steps doesn't add up
+                self.deadline += code[self.pc + 1]
+                self.pc += 2
                 return
-            self.commands[instruction].start_func()
-            time.sleep(1)
-            if self.commands[instruction].finish_func:
-                self.commands[instruction].finish_func()
+            elif op == FINISH:
+                self.finish_step()
+            elif op == LOOP:
+                self.counters[code[self.pc + 1]] = code[self.pc + 2]
+            elif op == NEXT:
+                slot = code[self.pc + 1]
+                self.counters[slot] -= 1
+                if self.counters[slot] > 0:
+                    self.pc = code[self.pc + 2]
+                    continue
+            elif op == TEST:
+                reading = self.compiler.sensor_table[code[self.pc + 1]]()
+                if reading is None:
+                    # A sensor that isn't running can't pass or fail a condition
+                    self.finish_step()
+                    self.active = False
+                    self.display.display_at(1, 0, "No sensor data".ljust(16))
+                    self.progress_handler.fire("Sensor unavailable")
+                    return
+                if (reading < code[self.pc + 3]) == bool(code[self.pc + 2]):
+                    self.pc = code[self.pc + 4]
+                    continue
+            elif op == POLL:
+                self.polling = True
+                self.deadline = monotonic() + POLL_TIME
+                self.pc += 1
+                return
+            elif op == JUMP:
+                self.pc = code[self.pc + 1]
+                continue
+            self.pc += 1 + ARGUMENTS[op]
+        self.active = False
+        self.progress_handler.fire("Finished")
+
+    def finish_step(self):
+        if self.current and self.current.finish_func:
+            self.current.finish_func()
+        self.end_timing()
+        self.current = None
+        self.polling = False
+
+    def end_timing(self):
+        """ Record how late the current step ended, which is when the next one starts if it has no finish """
+        if self.timings and self.timings[-1][2] is None:
+            self.timings[-1][2] = monotonic() - self.deadline
+
+    def timing_report(self):
+        """ The worst start and end jitter of the latest run, in milliseconds """
+        if not self.timings:
+            return "No steps run"
+        start = max(abs(timing[1]) for timing in self.timings)
+        ends = [abs(timing[2]) for timing in self.timings if timing[2] is not None]
+        end = max(ends) if ends else 0
+        return "Jit %dms/%dms" % (start * 1000, end * 1000)
+
+    def view_timings(self):
+        self.display.display_at(1, 0, self.timing_report().ljust(16))
 
     def view(self):
         self.display.display_at(1, 0, str(self).ljust(16))
@@ -70,14 +443,45 @@ class Program(Component):
     def __str__(self):
         curr_count = 0
         string = ""
+        previous = None
         for instruction in self.instructions:
-            if string and instruction == string[-1]:
+            # Only single character instructions are counted, the rest are written out in full
+            if instruction == previous and len(instruction) == 1 and instruction not in "()":
                 curr_count += 1
             else:
                 if curr_count > 1:
                     string += str(curr_count)
                 string += instruction
                 curr_count = 1
+            previous = instruction
         if curr_count > 1:
             string += str(curr_count)
         return string
+
+def benchmark(steps=10000):
+    """
+    Compare the interpreter's dispatch with the old loop, which looked up
+    self.commands[instruction] for every step
+    """
+    program = Program(None)
+    for shortcut in "^v<>":
+        program.add_command(shortcut, shortcut, lambda: None, lambda: None)
+    program.instructions = list("^v<>" * (steps // 4))
+
+    def dictionary():
+        for instruction in program.instructions:
+            program.commands[instruction].start_func()
+            program.commands[instruction].finish_func()
+
+    def interpreter():
+        program.run()
+        while program.active:
+            program.execute()
+
+    program.compiled()
+    for name, func in [("dict lookup", dictionary), ("interpreter", interpreter)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=5))
+        print("%-12s %.2f us per step" % (name, seconds * 1000000 / steps))
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,67 @@
+import heapq
+import time
+from component import EventHandler
+
+# time.monotonic only arrived in Python 3.3
+monotonic = getattr(time, "monotonic", time.time)
+# Seconds to sleep when no component is scheduled, rather than spinning
+IDLE_TIME = 0.1
+
+class Scheduler(object):
+    """
+    This class runs each component's check() when its deadline comes round,
+    sleeping until the earliest one in between
+    """
+    def __init__(self, components=None):
+        self.queue = []
+        self.count = 0
+        # The count of each component's current entry, older entries are skipped
+        self.entries = {}
+        self.overruns = {}
+        self.overrun_handler = EventHandler()
+        for component in components or []:
+            self.add(component)
+
+    def add(self, component, deadline=None):
+        if component.period is None:
+            return
+        if deadline is None:
+            deadline = monotonic()
+        # The count breaks ties so components are never compared
+        self.count += 1
+        self.entries[component] = self.count
+        component.scheduler = self
+        heapq.heappush(self.queue, (deadline, self.count, component))
+
+    def wake(self, component, deadline=None):
+        """ Check a component at deadline, or now, instead of when it was due """
+        self.add(component, deadline)
+
+    def run_once(self):
+        if not self.queue:
+            time.sleep(IDLE_TIME)
+            return
+        deadline, count, component = heapq.heappop(self.queue)
+        if self.entries.get(component) != count:
+            # Rescheduled by wake()
+            return
+        delay = deadline - monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        component.check()
+        now = monotonic()
+        next_deadline = component.next_check(deadline)
+        if next_deadline < now:
+            self.overrun(component, now - next_deadline)
+            next_deadline = now
+        self.add(component, next_deadline)
+
+    def overrun(self, component, late):
+        name = component.__class__.__name__
+        self.overruns[name] = self.overruns.get(name, 0) + 1
+        self.overrun_handler.fire(component, late)
+
+    def report(self):
+        if not self.overruns:
+            return "No overruns"
+        return " ".join(name[:4] + ":" + str(count) for name, count in sorted(self.overruns.items()))
@@ -1,19 +1,260 @@
-from subprocess import call
-from component import Component
+import collections
+import os
+import threading
+import time
+import Queue
+from subprocess import Popen, PIPE, call
+from archive import PhotoArchive
+from component import Component, EventHandler
+from scheduler import monotonic
 
 WEBCAM_PHOTO_FILE = "gushpibot_pic.jpg"
+WEBCAM_DEVICE = "/dev/video0"
+# Limits on the capture, to spare the Pi's CPU. Photos come from the same
+# capture, so the resolution is the photo resolution
+STREAM_FPS = 5
+STREAM_RESOLUTION = "640x480"
+# Recent frames kept in memory for photos
+FRAME_RING_SIZE = 10
+# Seconds between checks for a due timelapse photo
+TIMELAPSE_CHECK = 0.5
+
+class CaptureSource(object):
+    """
+    This class reads JPEG frames from a long running ffmpeg capture of the webcam
+    Requires ffmpeg commandline utility
+    """
+    def __init__(self, device=WEBCAM_DEVICE, resolution=STREAM_RESOLUTION, fps=STREAM_FPS):
+        self.device = device
+        self.resolution = resolution
+        self.fps = fps
+        self.process = None
+        self.buffer = b""
+
+    def open(self):
+        self.buffer = b""
+        # Raises OSError when ffmpeg is not installed
+        self.process = Popen(["ffmpeg", "-loglevel", "quiet", "-f", "video4linux2",
+                              "-s", self.resolution, "-r", str(self.fps), "-i", self.device,
+                              "-f", "mjpeg", "-q:v", "5", "-"], stdout=PIPE)
+
+    def read(self):
+        """ Return the next frame, or None if the capture has ended """
+        while True:
+            start = self.buffer.find(b"\xff\xd8")
+            end = self.buffer.find(b"\xff\xd9", start)
+            if start >= 0 and end >= 0:
+                frame = self.buffer[start:end + 2]
+                self.buffer = self.buffer[end + 2:]
+                return frame
+            chunk = os.read(self.process.stdout.fileno(), 65536)
+            if not chunk:
+                return None
+            self.buffer += chunk
+
+    def close(self):
+        if self.process:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+class FileSource(object):
+    """
+    This class stands in for the webcam, replaying JPEG files in a loop
+    """
+    def __init__(self, filenames, fps=STREAM_FPS):
+        self.filenames = filenames
+        self.fps = fps
+        self.index = 0
+
+    def open(self):
+        self.index = 0
+
+    def read(self):
+        time.sleep(1.0 / self.fps)
+        with open(self.filenames[self.index % len(self.filenames)], "rb") as frame_file:
+            frame = frame_file.read()
+        self.index += 1
+        return frame
+
+    def close(self):
+        pass
+
+class FrameStream(object):
+    """
+    This class runs a single capture, sharing each frame with every viewer and
+    keeping the most recent frames in a ring. Unless started as persistent, the
+    capture starts with the first viewer and stops after the last one leaves
+    """
+    def __init__(self, source, fps=STREAM_FPS, ring_size=FRAME_RING_SIZE):
+        self.source = source
+        self.interval = 1.0 / fps
+        self.frame = None
+        self.sequence = 0
+        self.frames = collections.deque(maxlen=ring_size)
+        self.viewers = 0
+        self.persistent = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        """ Keep capturing whether or not anyone is watching """
+        with self.condition:
+            self.persistent = True
+            self.start_capture()
+
+    def stop(self):
+        with self.condition:
+            self.persistent = False
+
+    def add_viewer(self):
+        with self.condition:
+            self.viewers += 1
+            self.start_capture()
+
+    def start_capture(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def remove_viewer(self):
+        with self.condition:
+            self.viewers -= 1
+
+    def wait_frame(self, sequence, timeout):
+        """ Return (sequence, frame) once there is a frame newer than sequence, or None """
+        with self.condition:
+            if self.sequence == sequence:
+                self.condition.wait(timeout)
+            if self.sequence == sequence:
+                return None
+            return self.sequence, self.frame
+
+    def recent(self, count=None):
+        """ The newest frames in the ring as (timestamp, frame), oldest first """
+        frames = list(self.frames)
+        return frames[-count:] if count else frames
+
+    def latest(self):
+        frames = self.recent(1)
+        return frames[0][1] if frames else None
+
+    def run(self):
+        try:
+            self.source.open()
+            opened = True
+        except OSError:
+            opened = False
+        last_time = 0
+        while True:
+            frame = self.source.read() if opened else None
+            with self.condition:
+                if frame is None or (self.viewers == 0 and not self.persistent):
+                    self.source.close()
+                    self.frames.clear()
+                    self.thread = None
+                    self.condition.notify_all()
+                    return
+                now = monotonic()
+                if now - last_time >= self.interval:
+                    last_time = now
+                    self.frame = frame
+                    self.frames.append((time.time(), frame))
+                    self.sequence += 1
+                    self.condition.notify_all()
 
 class Webcam(Component):
     """
     This class controls the USB webcam
     Requires fswebcam commandline utility
     (I did try pygame, but this seems to get upset in a headless sudo environment)
+    Every photo is also filed in the photo archive
     """
-    def __init__(self):
-        pass
+    period = TIMELAPSE_CHECK
+
+    def __init__(self, source=None, persistent=True, archive=None):
+        self.photo_handler = EventHandler()
+        self.stream = FrameStream(source or CaptureSource())
+        if persistent:
+            self.stream.start()
+        self.archive = archive or PhotoArchive()
+        # Functions giving the 'Bot's state, stored with each photo
+        self.metadata = {}
+        self.timelapse_interval = None
+        self.timelapse_left = 0
+        self.next_shot = 0
+        self.writes = Queue.Queue()
+        self.writer = threading.Thread(target=self.write_frames)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def cleanup(self):
+        self.stream.stop()
+        self.writes.put(None)
+        self.writer.join()
+        self.archive.cleanup()
 
     def update_menu(self, menu):
         menu.add_function("Take Photo", self.take_photo)
+        folder = menu.add_folder("Webcam")
+        menu.add_function("Burst Photos", self.burst, folder)
+        menu.add_function("Timelapse 1/5s", lambda: self.timelapse(5, 60), folder)
+        menu.add_function("Stop Timelapse", lambda: self.timelapse(None, 0), folder)
+
+    def state(self):
+        return dict((name, self.metadata[name]()) for name in self.metadata)
 
     def take_photo(self, filename=WEBCAM_PHOTO_FILE):
-        call(["fswebcam", "-d", "/dev/video0", "-r", "640x480", "--no-banner", filename])
+        frame = self.stream.latest()
+        if frame is None:
+            # No capture running, so fall back to grabbing a single frame
+            try:
+                result = call(["fswebcam", "-d", WEBCAM_DEVICE, "-r", STREAM_RESOLUTION, "--no-banner", filename])
+            except OSError:
+                result = None
+            if result != 0:
+                # Most likely the device is busy, and the file still holds the last photo
+                return
+            try:
+                with open(filename, "rb") as photo_file:
+                    self.archive.add(photo_file.read(), time.time(), **self.state())
+            except IOError:
+                return
+            self.photo_handler.fire(filename)
+        else:
+            self.writes.put((frame, time.time(), self.state(), filename))
+
+    def burst(self, count=FRAME_RING_SIZE):
+        """ Archive the frames already in the ring, without capturing any more """
+        state = self.state()
+        for taken, frame in self.stream.recent(count):
+            self.writes.put((frame, taken, state, None))
+
+    def timelapse(self, interval, count):
+        self.timelapse_interval = interval
+        self.timelapse_left = count
+        self.next_shot = monotonic()
+
+    def check(self):
+        if self.timelapse_left <= 0 or monotonic() < self.next_shot:
+            return
+        frame = self.stream.latest()
+        if frame is not None:
+            self.writes.put((frame, time.time(), self.state(), None))
+        self.timelapse_left -= 1
+        self.next_shot += self.timelapse_interval
+
+    def write_frames(self):
+        while True:
+            item = self.writes.get()
+            if item is None:
+                return
+            frame, taken, state, filename = item
+            self.archive.add(frame, taken, **state)
+            if filename:
+                # Write then rename, so the webserver never sends half a photo
+                with open(filename + ".tmp", "wb") as photo_file:
+                    photo_file.write(frame)
+                os.rename(filename + ".tmp", filename)
+                self.photo_handler.fire(filename)
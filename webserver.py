@@ -1,31 +1,388 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
 import threading
+import zlib
+import Queue
 import urlparse
 import BaseHTTPServer
 import SimpleHTTPServer
+import SocketServer
 from component import Component
+from scheduler import monotonic
 
 WEBSERVER_PORT = 80
+# These jump to the front of the command queue
+PRIORITY_COMMANDS = ["stop"]
+# Queued commands that a priority command takes the place of
+MOVEMENT_COMMANDS = ["up", "down", "left", "right"]
+# Seconds a request waits for the main loop to run its command
+COMMAND_TIMEOUT = 2
+# Seconds between comments sent to keep an idle event stream open
+EVENT_KEEPALIVE = 15
+# Events held for a browser that is not keeping up, before they are dropped
+EVENT_BACKLOG = 100
+MJPEG_BOUNDARY = "gushpibotframe"
+# Seconds a viewer waits for a frame before giving up on the stream
+FRAME_TIMEOUT = 10
+GALLERY_PAGE_SIZE = 20
+ARCHIVE_PATH = re.compile(r"^/photos/(\d+)(_thumb)?\.jpg$")
+# Static files up to this size are kept in memory
+ASSET_MAX_SIZE = 1000000
+# Seconds between checking that a cached file is unchanged on disk
+ASSET_CHECK_INTERVAL = 1
+
+log = logging.getLogger(__name__)
+
+class AssetCache(object):
+    """
+    This class keeps small static files in memory, each with an ETag and, for
+    text, a gzipped copy. Entries are checked against the file's mtime, except
+    watched files which stay cached until they are invalidated
+    """
+    class Asset(object):
+        def __init__(self, body, content_type, mtime):
+            self.body = body
+            self.content_type = content_type
+            self.mtime = mtime
+            self.checked = monotonic()
+            self.etag = '"%s"' % hashlib.md5(body).hexdigest()
+            self.gzipped = None
+            if content_type.startswith("text/") or content_type in ["application/javascript", "application/json"]:
+                compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                self.gzipped = compressor.compress(body) + compressor.flush()
+                self.gzipped_etag = self.etag[:-1] + '-gzip"'
+
+    def __init__(self):
+        self.assets = {}
+        self.watched = set()
+        # Bumped by invalidate(), so a file read before an invalidation is never stored
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def watch(self, path):
+        self.watched.add(os.path.abspath(path))
+
+    def invalidate(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            self.assets.pop(path, None)
+            self.generations[path] = self.generations.get(path, 0) + 1
+
+    def get(self, path, content_type):
+        """ The cached asset for path, or None if it is missing or too big to cache """
+        path = os.path.abspath(path)
+        now = monotonic()
+        with self.lock:
+            asset = self.assets.get(path)
+            generation = self.generations.get(path, 0)
+        if asset and (path in self.watched or now - asset.checked < ASSET_CHECK_INTERVAL):
+            return asset
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            return None
+        if asset and asset.mtime == stat.st_mtime:
+            asset.checked = now
+            return asset
+        if not os.path.isfile(path) or stat.st_size > ASSET_MAX_SIZE:
+            return None
+        with open(path, "rb") as asset_file:
+            asset = AssetCache.Asset(asset_file.read(), content_type, stat.st_mtime)
+        with self.lock:
+            if self.generations.get(path, 0) == generation:
+                self.assets[path] = asset
+        return asset
 
 class Webserver(Component):
+    """
+    This class serves the web page from its own threads. Commands posted to it
+    are queued and run by the main loop, in turn with everything else
+    """
+    period = 0.02
+
+    class Command(object):
+        def __init__(self, name, func, *args):
+            self.name = name
+            self.func = func
+            self.args = args
+            self.result = None
+            self.error = None
+            self.done = threading.Event()
+            self.lock = threading.Lock()
+            self.started = False
+            self.cancelled = False
+
+        def cancel(self, result=None):
+            """ Stop the command from running, unless it already has """
+            with self.lock:
+                if self.started:
+                    return False
+                self.cancelled = True
+            self.result = result
+            self.done.set()
+            return True
+
+        def run(self):
+            with self.lock:
+                if self.cancelled:
+                    return
+                self.started = True
+            try:
+                self.result = self.func(*self.args)
+            except Exception as error:
+                self.error = error
+            self.done.set()
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            # Browsers leaving a stream are expected, anything else is logged away from the curses screen
+            if not isinstance(sys.exc_info()[1], socket.error):
+                log.exception("Error handling request from %s", client_address[0])
+
     class WebHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        # Allows keep-alive, so every response must give its Content-Length
+        protocol_version = "HTTP/1.1"
+
         def log_message(self, format, *args):
             pass
 
         def do_GET(self):
+            if self.path == "/events":
+                return self.send_events()
+            if self.path == "/stream.mjpg":
+                return self.send_stream()
+            url = urlparse.urlparse(self.path)
+            if url.path == "/gallery":
+                return self.send_gallery(urlparse.parse_qs(url.query))
+            if ARCHIVE_PATH.match(url.path):
+                return self.send_archived(*ARCHIVE_PATH.match(url.path).groups())
             if self.path == "/":
                 self.path = "/index.html"
-            return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+            path = self.translate_path(self.path)
+            asset = self.server.webserver.assets.get(path, self.guess_type(path))
+            if asset is None:
+                return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+            self.send_asset(asset)
+
+        def send_asset(self, asset):
+            body, etag = asset.body, asset.etag
+            gzipped = asset.gzipped is not None and "gzip" in self.headers.get("Accept-Encoding", "")
+            if gzipped:
+                body, etag = asset.gzipped, asset.gzipped_etag
+            if etag in self.headers.get("If-None-Match", ""):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", asset.content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            # Browsers may keep a copy, but must check it is still current
+            self.send_header("Cache-Control", "no-cache")
+            if asset.gzipped is not None:
+                self.send_header("Vary", "Accept-Encoding")
+            if gzipped:
+                self.send_header("Content-Encoding", "gzip")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_events(self):
+            """ Stream published state changes as Server-Sent Events """
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = 1
+            listener = self.server.webserver.listen()
+            try:
+                while True:
+                    try:
+                        event, data = listener.get(timeout=EVENT_KEEPALIVE)
+                        self.wfile.write("event: %s\ndata: %s\n\n" % (event, data.replace("\n", "\ndata: ")))
+                    except Queue.Empty:
+                        self.wfile.write(": keepalive\n\n")
+                    self.wfile.flush()
+            except socket.error:
+                pass
+            finally:
+                self.server.webserver.unlisten(listener)
+
+        def send_stream(self):
+            """ Stream webcam frames as multipart MJPEG """
+            stream = self.server.webserver.frame_stream
+            if not stream:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=" + MJPEG_BOUNDARY)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = 1
+            stream.add_viewer()
+            sequence = 0
+            try:
+                while True:
+                    frame = stream.wait_frame(sequence, FRAME_TIMEOUT)
+                    if frame is None:
+                        break
+                    sequence, jpeg = frame
+                    self.wfile.write("--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+                                     % (MJPEG_BOUNDARY, len(jpeg)))
+                    self.wfile.write(jpeg)
+                    self.wfile.write("\r\n")
+                    self.wfile.flush()
+            except socket.error:
+                pass
+            finally:
+                stream.remove_viewer()
+
+        def send_gallery(self, query):
+            archive = self.server.webserver.archive
+            if not archive:
+                self.send_error(404)
+                return
+            try:
+                page = max(0, int(query.get("page", ["0"])[0]))
+                per_page = max(1, min(100, int(query.get("per_page", [str(GALLERY_PAGE_SIZE)])[0])))
+            except ValueError:
+                self.send_error(400)
+                return
+            photos, pages = archive.page(page, per_page)
+            self.send_text(json.dumps({"page": page, "pages": pages, "photos": photos}),
+                           content_type="application/json")
+
+        def send_archived(self, photo_id, thumbnail):
+            """ Photos never change once archived, so browsers may keep them """
+            archive = self.server.webserver.archive
+            path = archive and archive.path(int(photo_id), bool(thumbnail))
+            try:
+                with open(path, "rb") as photo_file:
+                    photo = photo_file.read()
+            except (IOError, TypeError):
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(photo)))
+            self.send_header("Cache-Control", "max-age=31536000")
+            self.end_headers()
+            self.wfile.write(photo)
 
         def do_POST(self):
-            self.wfile.write(self.server.post_handlers[self.path[1:]]())
+            length = int(self.headers.get("Content-Length", 0))
+            data = self.rfile.read(length)
+            name = self.path[1:]
+            webserver = self.server.webserver
+            if name in webserver.post_data_handlers:
+                command = webserver.queue(name, data)
+            elif name in webserver.post_handlers:
+                command = webserver.queue(name)
+            else:
+                self.send_error(404)
+                return
+            if not command.done.wait(COMMAND_TIMEOUT):
+                if command.cancel():
+                    self.send_error(503)
+                    return
+                # Too late to cancel, the main loop is running it now
+                command.done.wait()
+            if isinstance(command.error, ValueError):
+                self.send_text(str(command.error), 400)
+                return
+            if command.error:
+                self.send_error(500)
+                return
+            self.send_text("" if command.result is None else str(command.result))
+
+        def send_text(self, text, status=200, content_type="text/plain"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(text)))
+            self.end_headers()
+            self.wfile.write(text)
 
     def __init__(self):
         self.post_handlers = {}
+        # Handlers given the body of the request
+        self.post_data_handlers = {}
+        self.commands = collections.deque()
+        self.commands_lock = threading.Lock()
+        self.listeners = []
+        self.listeners_lock = threading.Lock()
+        # Latest data for each event, sent to browsers as they connect
+        self.state = collections.OrderedDict()
+        self.frame_stream = None
+        self.archive = None
+        self.assets = AssetCache()
         self.httpd = None
 
+    def publish(self, event, data):
+        data = str(data)
+        with self.listeners_lock:
+            if self.state.get(event) == data:
+                return
+            self.state[event] = data
+            for listener in self.listeners:
+                try:
+                    listener.put_nowait((event, data))
+                except Queue.Full:
+                    pass
+
+    def listen(self):
+        listener = Queue.Queue(EVENT_BACKLOG)
+        with self.listeners_lock:
+            for event in self.state:
+                listener.put_nowait((event, self.state[event]))
+            self.listeners.append(listener)
+        return listener
+
+    def unlisten(self, listener):
+        with self.listeners_lock:
+            self.listeners.remove(listener)
+
+    def queue(self, name, data=None):
+        if data is None:
+            command = Webserver.Command(name, self.post_handlers[name])
+        else:
+            command = Webserver.Command(name, self.post_data_handlers[name], data)
+        with self.commands_lock:
+            if name in PRIORITY_COMMANDS:
+                # Moves sent before the stop must not run after it
+                for queued in self.commands:
+                    if queued.name in MOVEMENT_COMMANDS:
+                        queued.cancel("Cancelled by " + name)
+                self.commands = collections.deque(queued for queued in self.commands if not queued.cancelled)
+                self.commands.appendleft(command)
+            else:
+                self.commands.append(command)
+        return command
+
+    def check(self):
+        while True:
+            with self.commands_lock:
+                if not self.commands:
+                    return
+                command = self.commands.popleft()
+            # Commands whose request has given up waiting are skipped
+            command.run()
+
     def serve(self):
-        self.httpd = BaseHTTPServer.HTTPServer(('0.0.0.0', WEBSERVER_PORT), Webserver.WebHandler)
-        self.httpd.post_handlers = self.post_handlers
+        self.httpd = Webserver.Server(('0.0.0.0', WEBSERVER_PORT), Webserver.WebHandler)
+        self.httpd.webserver = self
         self.t = threading.Thread(target=self.httpd.serve_forever)
         self.t.daemon = False
         self.t.start()
@@ -33,3 +390,78 @@ class Webserver(Component):
     def cleanup(self):
         if self.httpd:
             self.httpd.shutdown()
+
+def check_stream(filenames, viewers=2, frames=5):
+    """
+    Serve FileSource frames on a spare port and read the MJPEG stream with several
+    viewers at once, checking each gets whole frames in order from the one capture
+    """
+    from webcam import FileSource, FrameStream
+    webserver = Webserver()
+    webserver.frame_stream = FrameStream(FileSource(filenames))
+    httpd = Webserver.Server(("127.0.0.1", 0), Webserver.WebHandler)
+    httpd.webserver = webserver
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    contents = []
+    for filename in filenames:
+        with open(filename, "rb") as frame_file:
+            contents.append(frame_file.read())
+    received = [None] * viewers
+
+    def view(viewer):
+        sock = socket.create_connection(httpd.server_address)
+        sock.sendall("GET /stream.mjpg HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        stream = sock.makefile("rb")
+        assert stream.readline().split()[1] == "200"
+        headers = {}
+        for line in iter(stream.readline, "\r\n"):
+            name, value = line.split(":", 1)
+            headers[name.lower()] = value.strip()
+        assert headers["content-type"] == "multipart/x-mixed-replace; boundary=" + MJPEG_BOUNDARY
+        jpegs = []
+        for frame in range(frames):
+            assert stream.readline() == "--%s\r\n" % MJPEG_BOUNDARY
+            part = {}
+            for line in iter(stream.readline, "\r\n"):
+                name, value = line.split(":", 1)
+                part[name.lower()] = value.strip()
+            assert part["content-type"] == "image/jpeg"
+            jpegs.append(stream.read(int(part["content-length"])))
+            assert stream.read(2) == "\r\n"
+        sock.close()
+        received[viewer] = jpegs
+
+    threads = [threading.Thread(target=view, args=(viewer,)) for viewer in range(viewers)]
+    for viewer in threads:
+        viewer.start()
+    for viewer in threads:
+        viewer.join()
+    httpd.shutdown()
+    for jpegs in received:
+        assert jpegs is not None, "a viewer failed"
+        # Whole frames, each following on from the one before
+        positions = [contents.index(jpeg) for jpeg in jpegs]
+        for previous, position in zip(positions, positions[1:]):
+            assert position == (previous + 1) % len(contents), "frames out of order"
+    captured = webserver.frame_stream.sequence
+    # Viewers share one capture, rather than each reading its own frames
+    assert captured < viewers * frames, "each viewer had its own capture"
+    print("%d viewers each got %d whole frames, from %d captured" % (viewers, frames, captured))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        check_stream(sys.argv[1:])
+    else:
+        # Stand-in frames, as only the JPEG markers matter to the stream
+        directory = tempfile.mkdtemp()
+        filenames = []
+        for frame in range(3):
+            filenames.append(os.path.join(directory, "frame%d.jpg" % frame))
+            with open(filenames[-1], "wb") as frame_file:
+                frame_file.write("\xff\xd8frame %d\xff\xd9" % frame)
+        try:
+            check_stream(filenames)
+        finally:
+            shutil.rmtree(directory)
@@ -1,49 +1,153 @@
+import collections
+import threading
+import time
 import RPi.GPIO as GPIO
-from component import Component, EventHandler
+from component import Component, EventHandler, LOW
+from scheduler import monotonic
+
+PWM_FREQUENCY = 100
+# Speed change per second, where 1 is full speed
+ACCELERATION = 4.0
+# Seconds between speed changes while ramping
+RAMP_INTERVAL = 0.02
+# Ramp ticks kept for measuring jitter
+JITTER_KEPT = 500
 
 class Wheels(Component):
     """
-    This class controls the motors and makes the 'Bot move
+    This class controls the motors and makes the 'Bot move.
+    Each wheel runs at a speed from -1 (full backwards) to 1 (full forwards), set by
+    PWM, and a ramp thread changes speed no faster than the acceleration allows.
+    A command for the speeds the motors are already heading to is skipped, without
+    firing any events
     """
-    def __init__(self, pin_1a=17, pin_1b=18, pin_2a=22, pin_2b=23):
+    PHRASES = ["Stopping", "Going Forwards", "Going Backwards", "Turning Right",
+               "Turning Right Slowly", "Turning Left", "Turning Left Slowly"]
+
+    def __init__(self, pin_1a=17, pin_1b=18, pin_2a=22, pin_2b=23, acceleration=ACCELERATION):
+        # Motor 1 drives the left wheel, motor 2 the right
         self.pins = [pin_1a, pin_1b, pin_2a, pin_2b]
+        self.pwms = []
         for pin in self.pins:
             GPIO.setup(pin, GPIO.OUT)
-        self.speech_handler = EventHandler()
+            pwm = GPIO.PWM(pin, PWM_FREQUENCY)
+            pwm.start(0)
+            self.pwms.append(pwm)
+        self.acceleration = acceleration
+        self.speech_handler = EventHandler(LOW, asynchronous=True)
+        self.state_handler = EventHandler()
+        self.state = "stop"
+        self.target = (0, 0)
+        self.speeds = [0, 0]
+        self.duties = [0, 0, 0, 0]
+        # How late each ramp tick was, in seconds
+        self.jitter = collections.deque(maxlen=JITTER_KEPT)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.applied = 0
+        self.elided = 0
+        self.active = True
+        self.thread = threading.Thread(target=self.ramp)
+        self.thread.daemon = True
+        self.thread.start()
 
     def cleanup(self):
-        self.stop()
+        with self.lock:
+            self.active = False
+            self.changed.notify()
+        self.thread.join()
+        self.emergency_stop()
+        for pwm in self.pwms:
+            pwm.stop()
         for pin in self.pins:
             GPIO.cleanup(pin)
 
-    def send_command(self, command):
-        for i in range(4):
-            GPIO.output(self.pins[i], command[i])
+    def drive(self, left, right, state=None, phrase=None):
+        """ Head for the given wheel speeds, each from -1 to 1 """
+        target = (max(-1, min(1, left)), max(-1, min(1, right)))
+        state = state or "%+.1f %+.1f" % target
+        with self.lock:
+            if target == self.target:
+                self.elided += 1
+                return
+            self.target = target
+            self.state = state
+            self.applied += 1
+            self.changed.notify()
+        self.state_handler.fire(state)
+        if phrase:
+            self.speech_handler.fire(phrase)
+
+    def emergency_stop(self):
+        """ Cut both motors at once, without ramping down """
+        with self.lock:
+            stopped = self.target == (0, 0) and self.speeds == [0, 0]
+            self.target = (0, 0)
+            self.speeds = [0, 0]
+            self.write()
+            self.state = "stop"
+        if not stopped:
+            self.state_handler.fire("stop")
+            self.speech_handler.fire("Stopping")
+
+    def ramp(self):
+        deadline = monotonic()
+        while True:
+            with self.lock:
+                while self.active and list(self.target) == self.speeds:
+                    self.changed.wait()
+                    deadline = monotonic()
+                if not self.active:
+                    return
+                self.jitter.append(monotonic() - deadline)
+                step = self.acceleration * RAMP_INTERVAL
+                for wheel in range(2):
+                    difference = self.target[wheel] - self.speeds[wheel]
+                    self.speeds[wheel] += max(-step, min(step, difference))
+                self.write()
+            # Ticks follow on from each other, so a late one doesn't slow the ramp
+            deadline += RAMP_INTERVAL
+            delay = deadline - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def write(self):
+        """ Set the PWM duty cycles for the current speeds, turning pins down before any go up """
+        duties = []
+        for speed in self.speeds:
+            duties += [speed * 100, 0] if speed >= 0 else [0, -speed * 100]
+        changed = [i for i in range(4) if duties[i] != self.duties[i]]
+        for i in sorted(changed, key=lambda i: duties[i] > self.duties[i]):
+            self.pwms[i].ChangeDutyCycle(duties[i])
+        self.duties = duties
+
+    def report(self):
+        return "Set:%d Skip:%d" % (self.applied, self.elided)
+
+    def jitter_report(self):
+        """ The worst and average lateness of recent ramp ticks, in milliseconds """
+        jitter = list(self.jitter)
+        if not jitter:
+            return "No ramps yet"
+        return "Ramp %.1f/%.1fms" % (max(jitter) * 1000, sum(jitter) / len(jitter) * 1000)
 
     def stop(self):
-        self.send_command([0, 0, 0, 0])
-        self.speech_handler.fire("Stopping")
+        self.drive(0, 0, "stop", "Stopping")
 
     def forwards(self):
-        self.send_command([1, 0, 1, 0])
-        self.speech_handler.fire("Going Forwards")
+        self.drive(1, 1, "forwards", "Going Forwards")
 
     def backwards(self):
-        self.send_command([0, 1, 0, 1])
-        self.speech_handler.fire("Going Backwards")
+        self.drive(-1, -1, "backwards", "Going Backwards")
 
     def right(self):
-        self.send_command([1, 0, 0, 1])
-        self.speech_handler.fire("Turning Right")
+        self.drive(1, -1, "right", "Turning Right")
 
     def slow_right(self):
-        self.send_command([1, 0, 0, 0])
-        self.speech_handler.fire("Turning Right Slowly")
+        self.drive(1, 0, "slow_right", "Turning Right Slowly")
 
     def left(self):
-        self.send_command([0, 1, 1, 0])
-        self.speech_handler.fire("Turning Left")
+        self.drive(-1, 1, "left", "Turning Left")
 
     def slow_left(self):
-        self.send_command([0, 0, 1, 0])
-        self.speech_handler.fire("Turning Left Slowly")
+        self.drive(0, 1, "slow_left", "Turning Left Slowly")
@@ -1,16 +1,22 @@
 # sudo apt-get install python-cwiid
 # Python 2 only :(
 import cwiid
-from component import Component, EventHandler
+from component import Component, EventHandler, NORMAL, SAFETY
+
+# Buttons that move the 'Bot, which take over again when another button is let go
+MOVEMENT_BUTTONS = ["UP", "DOWN", "LEFT", "RIGHT"]
 
 class Wiimote(Component):
     """
     This class listens out for activity on the Wii Controller, and acts accordingly
     """
+    # Buttons only fire as they are pressed, so checking often costs little
+    period = 0.02
+
     class ButtonHandler(EventHandler):
 
-        def __init__(self, button_id):
-            EventHandler.__init__(self)
+        def __init__(self, button_id, priority=NORMAL):
+            EventHandler.__init__(self, priority)
             self.button_id = button_id
 
     def __init__(self, display=None):
@@ -19,7 +25,7 @@ class Wiimote(Component):
         self.handlers = {}
         self.handlers["1"] = Wiimote.ButtonHandler(cwiid.BTN_1)
         self.handlers["2"] = Wiimote.ButtonHandler(cwiid.BTN_2)
-        self.handlers["A"] = Wiimote.ButtonHandler(cwiid.BTN_A)
+        self.handlers["A"] = Wiimote.ButtonHandler(cwiid.BTN_A, SAFETY)
         self.handlers["B"] = Wiimote.ButtonHandler(cwiid.BTN_B)
         self.handlers["UP"] = Wiimote.ButtonHandler(cwiid.BTN_UP)
         self.handlers["DOWN"] = Wiimote.ButtonHandler(cwiid.BTN_DOWN)
@@ -29,6 +35,7 @@ class Wiimote(Component):
         self.handlers["PLUS"] = Wiimote.ButtonHandler(cwiid.BTN_PLUS)
         self.handlers["HOME"] = Wiimote.ButtonHandler(cwiid.BTN_HOME)
         self.stop_handler = None
+        self.buttons = 0
 
     def cleanup(self):
         if self.wiim:
@@ -50,8 +57,17 @@ class Wiimote(Component):
     def check(self):
         if not self.wiim:
             return
-        if self.stop_handler:
+        buttons = self.wiim.state["buttons"]
+        if buttons == self.buttons:
+            return
+        released = self.buttons & ~buttons
+        pressed = buttons & ~self.buttons
+        self.buttons = buttons
+        # Letting go stops the 'Bot, then any movement buttons still held take over again
+        if released and self.stop_handler:
             self.stop_handler()
+            for button in MOVEMENT_BUTTONS:
+                pressed |= buttons & self.handlers[button].button_id
         for button in self.handlers:
-            if self.wiim.state["buttons"] & self.handlers[button].button_id:
+            if pressed & self.handlers[button].button_id:
                 self.handlers[button].fire()